@@ -1,120 +1,231 @@
+import functools
 import os
+import subprocess
 import sys
-import xml.etree.ElementTree as ET
-from difflib import SequenceMatcher
-from zipfile import ZipFile
-import shutil
+import plistlib
 import stat
+from typing import Optional
 
+import numpy as np
+import orjson
 import requests
+from requests.adapters import HTTPAdapter
+from remotezip import RemoteZip
 
 ### Consts used in the retrieval of the Chrome version number
-CHROME_PLIST_PATH = "/Applications/Google Chrome.app/Contents/Info.plist"
-XML_VERSION_KEY = "KSVersion"
-
-
+CHROME_APP_PATH = "/Applications/Google Chrome.app"
+CHROME_PLIST_PATH = CHROME_APP_PATH + "/Contents/Info.plist"
+PLIST_VERSION_KEY = "KSVersion"
+
+### Consts used in the retrieval of the chromedriver download url
+# I found this url by following the below URLs:
+# - https://developer.chrome.com/docs/chromedriver/downloads
+# - https://googlechromelabs.github.io/chrome-for-testing/
+# - https://github.com/GoogleChromeLabs/chrome-for-testing#json-api-endpoints
+VERSIONS_JSON_URL = "https://googlechromelabs.github.io/chrome-for-testing/known-good-versions-with-downloads.json"
+
+# Where we keep a copy of the versions json (and the ETag the server gave us
+# for it) between runs, so repeat runs don't have to re-download it
+CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "chromedriver-utils")
+VERSIONS_CACHE_PATH = os.path.join(CACHE_DIR, "known-good-versions-with-downloads.json")
+ETAG_CACHE_PATH = VERSIONS_CACHE_PATH + ".etag"
+
+# Where we remember which chromedriver url each Chrome version resolved to,
+# so later runs (and later processes) can skip the json fetch + matching
+# entirely
+URL_MAP_CACHE_PATH = os.path.join(CACHE_DIR, "url-map.json")
+
+# The name of the sidecar file written next to a downloaded chromedriver,
+# recording its version so later runs don't have to ask the binary itself
+VERSION_SIDECAR_NAME = "chromedriver.version"
+
+# One session shared by every request this module makes. Plain requests.get()
+# spins up (and tears down) a whole Session - connection pool and all - per
+# call; sharing one keeps connections, TLS state and cookies warm across the
+# json fetch and the zip download. The explicit adapter sizes the pool for
+# the couple of hosts we talk to and retries transient connection failures
+# rather than bubbling them straight up
+_SESSION = requests.Session()
+_SESSION.mount(
+    "https://",
+    HTTPAdapter(pool_connections=4, pool_maxsize=4, max_retries=3),
+)
+
+
+@functools.lru_cache(maxsize=1)
 def get_chrome_version() -> str:
     """
     This function dynamically inspects the package contents of our Chrome
     application to grab the current version in the form of a string
 
+    The installed Chrome version can't change underneath a running process,
+    so the result is cached - repeat calls never hit Spotlight or re-read
+    Info.plist
+
     >>> get_chrome_version()
     "125.0.6422.113"
     """
 
-    # - To get the version of our Chrome application, we can inspect its
-    #   'Info.plist' file
-    # - Upon visual inspection, it seems to be an XML file
-    tree = ET.parse(CHROME_PLIST_PATH)
-
-    # - I did a Ctrl+F of the current version value, and it's found in a few
-    #   places
-    # - The most accessible is probably the one which is in a <string> tag
-    #   which has a corresponding <key> tag whose inner text is "KSVersion"
-    # - These tags are within a <dict> tag which is the first child of the
-    #   root of the XML tree
-    root = tree.getroot()
-    dict_tag = next(iter(root))
+    # Spotlight already indexes every application's version, so asking it
+    # via `mdls` returns the string straight from its cache with no parsing
+    # on our side at all. It prints "(null)" (or nothing) when it doesn't
+    # know, in which case we fall back to reading the plist ourselves below
+    try:
+        result = subprocess.run(
+            ["mdls", "-raw", "-name", "kMDItemVersion", CHROME_APP_PATH],
+            capture_output=True,
+            text=True,
+        )
+        version = result.stdout.strip()
+        if result.returncode == 0 and version and version != "(null)":
+            return version
+    except OSError:
+        pass
+
+    # - Failing that, we can inspect the Chrome application's 'Info.plist'
+    #   file directly
+    # - It's a plist, so rather than parsing it as raw XML and walking the
+    #   tags by hand, 'plistlib' (stdlib) parses it straight into a dict
+    # - The version value is found in a few places; the most accessible is
+    #   the one under the "KSVersion" key
+    with open(CHROME_PLIST_PATH, "rb") as file:
+        plist = plistlib.load(file)
+
+    try:
+        return plist[PLIST_VERSION_KEY]
+    except KeyError:
+        raise Exception("Didn't find version value for some reason :(")
+
+
+def _parse_version(version: str) -> tuple:
+    """
+    Parses a dotted version string (e.g. "125.0.6422.113") into a tuple of
+    ints (e.g. `(125, 0, 6422, 113)`), padding with zeros if there happen to
+    be fewer than four components
 
-    # To find the target <key>, we just iterate over each child of 'dict_tag'
-    # and check the inner text. If we find the one we want, we check the
-    # inner text of the next tag - this will be the version string that we
-    # want
+    >>> _parse_version("125.0.6422.113")
+    (125, 0, 6422, 113)
+    """
+    parts = [int(part) for part in version.split(".")]
+    return tuple(parts + [0] * (4 - len(parts)))
 
-    found_key = False
-    for child in dict_tag:
-        inner_text = child.text
 
-        # If we're looking for the "KSVersion" <key> tag
-        if not found_key:
+def _fetch_versions_json() -> bytes:
+    """
+    Fetches the known-good-versions json and returns its raw bytes, using a
+    conditional GET so that unchanged data is never re-downloaded.
 
-            # We only care about <key> tags
-            if child.tag != "key":
-                continue
+    We remember the `ETag` the server sent last time alongside a copy of the
+    body on disk. On the next run we send `If-None-Match` with that tag; if
+    the json hasn't changed the server replies 304 with an empty body, and
+    we just read our cached copy instead
+    """
+    etag = None
+    if os.path.exists(ETAG_CACHE_PATH) and os.path.exists(VERSIONS_CACHE_PATH):
+        with open(ETAG_CACHE_PATH) as file:
+            etag = file.read().strip()
+
+    # The json is extremely compressible (it's mostly repeated urls and
+    # version strings), and brotli squeezes it noticeably harder than the
+    # gzip that requests negotiates by default - so ask for it explicitly.
+    # urllib3 transparently decodes the response either way, since the
+    # 'Brotli' package is installed
+    headers = {"Accept-Encoding": "br, gzip"}
+    if etag is not None:
+        headers["If-None-Match"] = etag
+    response = _SESSION.get(VERSIONS_JSON_URL, headers=headers)
+
+    if response.status_code == 304:
+        with open(VERSIONS_CACHE_PATH, "rb") as file:
+            return file.read()
+
+    # We got a fresh body, so persist it (and its ETag) for next time
+    response.raise_for_status()
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    with open(VERSIONS_CACHE_PATH, "wb") as file:
+        file.write(response.content)
+
+    new_etag = response.headers.get("ETag")
+    if new_etag is not None:
+        with open(ETAG_CACHE_PATH, "w") as file:
+            file.write(new_etag)
+
+    return response.content
+
+
+def _load_url_map() -> dict:
+    """
+    Reads the on-disk version -> url map, returning an empty dict if it
+    doesn't exist (or has somehow been corrupted)
+    """
+    try:
+        with open(URL_MAP_CACHE_PATH, "rb") as file:
+            return orjson.loads(file.read())
+    except (OSError, orjson.JSONDecodeError):
+        return {}
 
-            if inner_text == XML_VERSION_KEY:
-                # The next tag will contain the version data
-                found_key = True
 
-        # We're now inspecting the <string> tag which will contain the version
-        # value. This means 'inner_text' will be the info we want
-        else:
-            return inner_text
+def _store_url(our_version: str, url: str) -> None:
+    """
+    Records in the on-disk map that `our_version` resolved to `url`
+    """
+    url_map = _load_url_map()
+    url_map[our_version] = url
 
-    raise Exception("Didn't find version value for some reason :(")
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    with open(URL_MAP_CACHE_PATH, "wb") as file:
+        file.write(orjson.dumps(url_map))
 
 
+@functools.lru_cache(maxsize=32)
 def get_chromedriver_download_url(our_version: str) -> str:
     """
     Given the version of our Chrome download, this function gets the url of
     the chromedriver download
 
-    Basically, we look for the download with the version number which is the
-    most similar to our Chrome download's version number. Idk how robust
-    this is, but it's all I could think of doing
+    Basically, we look for the download with the version number which is
+    numerically the closest to our Chrome download's version number
+
+    A given Chrome version always resolves to the same url, so results are
+    memoized both in-process (lru_cache) and on disk (the url map), meaning
+    repeat runs never even fetch the versions json
 
     >>> get_chromedriver_download_url("125.0.6422.113")
-    "https://storage.googleapis.com/chrome-for-testing-public/125.0.6422.3/mac-x64/chromedriver-mac-x64.zip"
+    "https://storage.googleapis.com/chrome-for-testing-public/125.0.6422.113/mac-x64/chromedriver-mac-x64.zip"
     """
 
+    ### Check whether a previous run already resolved this version ###
+    cached_url = _load_url_map().get(our_version)
+    if cached_url is not None:
+        return cached_url
+
     ### Grab the json containing all the versions & download urls ###
-    # I found this url by following the below URLs:
-    # - https://developer.chrome.com/docs/chromedriver/downloads
-    # - https://googlechromelabs.github.io/chrome-for-testing/
-    # - https://github.com/GoogleChromeLabs/chrome-for-testing#json-api-endpoints
-    json_url = "https://googlechromelabs.github.io/chrome-for-testing/known-good-versions-with-downloads.json"
-    response = requests.get(json_url)
-
-    # The base response json is a 'dict' with 'timestamp' and 'versions'
-    # data. "versions" is a list of dicts; each has a "version" key, whose
+    # The base json is a 'dict' with 'timestamp' and 'versions' data.
+    # "versions" is a list of dicts; each has a "version" key, whose
     # accompanying value is a string (e.g. "113.0.5672.0").
     # Obviously we don't care about the timestamp...
-    data = response.json()["versions"]
+    data = orjson.loads(_fetch_versions_json())["versions"]
 
     ### Find which is the most similar to our version ###
-    # Basically, the idea is to just manually compare the strings to see how
-    # similar they are. The most similar version will be the one we go with
-
-    # List of each version covered
-    # e.g. ['127.0.6508.0', '127.0.6509.0', '127.0.6510.0', ...]
-    version_numbers = (entry["version"] for entry in data)
-
-    most_similar__ratio = None
-    most_similar__index = None
-    for index, version in enumerate(version_numbers):
-        # Ref: https://stackoverflow.com/a/17388505
-        similarity = SequenceMatcher(None, version, our_version).ratio()
-
-        # If the most_similar__ variables are uninitialised
-        condition1 = (most_similar__ratio is None) and (most_similar__index is None)
-
-        # If the current similarity is better than the best recorded similarity
-        # so far
-        condition2 = (not condition1) and (similarity > most_similar__ratio)
+    # Version strings aren't really strings - they're four numbers - so we
+    # parse each one into a row of ints and keep the entry whose components
+    # are numerically closest to ours, comparing the most significant
+    # component first. The scoring runs as a handful of vectorized numpy
+    # ops over the whole candidate list at once rather than a Python-level
+    # loop; np.lexsort sorts by its *last* key first, so the columns are fed
+    # to it least-significant-first. An exact match scores (0, 0, 0, 0),
+    # which nothing can beat, so it no longer needs its own special case
+    parsed = np.array(
+        [_parse_version(entry["version"]) for entry in data], dtype=np.int32
+    )
+    our_parsed = np.array(_parse_version(our_version), dtype=np.int32)
 
-        if condition1 or condition2:
-            most_similar__ratio = similarity
-            most_similar__index = index
+    distances = np.abs(parsed - our_parsed)
+    most_similar__index = int(
+        np.lexsort(
+            (distances[:, 3], distances[:, 2], distances[:, 1], distances[:, 0])
+        )[0]
+    )
 
     ### Get the data corresponding to the most similar version ###
     most_similar = data[most_similar__index]
@@ -126,6 +237,10 @@ def get_chromedriver_download_url(our_version: str) -> str:
     platforms = most_similar["downloads"]["chromedriver"]
     mac_x64 = next(entry for entry in platforms if entry["platform"] == "mac-x64")
     url = mac_x64["url"]
+
+    # Remember the resolution for future processes
+    _store_url(our_version, url)
+
     return url
 
 
@@ -134,65 +249,87 @@ def download_chromedriver(url: str, dest_dir: str) -> str:
     Given the download url for the specific chromedriver version, this
     function:
 
-    - Downloads the zip file
-    - Unzips it
-    - Moves the 'chromedriver' executable in the resulting directory to
-      the destination directory `dest_dir`
-    - Removes the zip file and its resulting directory, including the
-      LICENSE.chromedriver file within
+    - Downloads *only* the bytes of the 'chromedriver' executable from the
+      zip file (the rest of the archive is never transferred)
+    - Extracts the executable straight into the destination directory
+      `dest_dir`, already marked as executable
 
     And returns the filepath of the `chromedriver` executable
     """
-    ### Download the .zip file ###
-
-    # Get the full path for the zip
-    zip_name = "chromedriver.zip"
-    zip_path = os.path.join(dest_dir, zip_name)
-
-    # Cheers ChatGPT
-    with requests.get(url, stream=True) as response:
-        response.raise_for_status()
-        with open(zip_path, "wb") as file:
-            for chunk in response.iter_content(chunk_size=8192):
-                if chunk:  # filter out keep-alive new chunks
-                    file.write(chunk)
-
-    ### Extract the .zip file ###
-    with ZipFile(zip_path, "r") as zip_ref:
-        zip_ref.extractall(dest_dir)
-
-    # The previous operation creates a new directory called 'chromedriver-'
-    # plus the platform name. It contains the chromedriver executable, as
-    # well as a LICENSE.chromedriver file
-    unzipped_dir = os.path.join(dest_dir, "chromedriver-mac-x64")
-
-    ### Move 'chromedriver' to the root of the project ###
-    chromedriver_src_path = os.path.join(unzipped_dir, "chromedriver")
+    ### Extract the executable straight from the remote .zip ###
+    # A zip's central directory lives at the end of the file, so RemoteZip
+    # can read it with an HTTP Range request and then fetch just the
+    # compressed bytes of the entries we open - the LICENSE.chromedriver
+    # file and the zip's other padding never cross the wire at all.
+    # The executable is inflated directly to its final path; no temp files,
+    # no subdirectory to clean up
     chromedriver_dest_path = os.path.abspath(
         os.path.join(dest_dir, "chromedriver"),
     )
-    shutil.move(chromedriver_src_path, chromedriver_dest_path)
-
-    ### Clean up .zip and the unzipped directory ###
-    os.remove(zip_path)
-    shutil.rmtree(unzipped_dir)
+    with RemoteZip(url, session=_SESSION) as zip_ref:
+        with zip_ref.open("chromedriver-mac-x64/chromedriver") as src:
+            # Write through a raw file descriptor rather than a buffered
+            # 'open()' file object - the inflated 1MiB chunks go straight to
+            # the kernel instead of being copied through BufferedWriter first
+            fd = os.open(chromedriver_dest_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC)
+            try:
+                while True:
+                    chunk = src.read(1 << 20)
+                    if not chunk:
+                        break
+                    os.write(fd, chunk)
+
+                # Make the executable, well, executable (the equivalent of
+                # `chmod +x ./chromedriver`) while the fd is still open,
+                # saving a separate path lookup + chmod syscall afterwards
+                os.fchmod(fd, stat.S_IRWXU)
+            finally:
+                os.close(fd)
 
     return chromedriver_dest_path
 
 
-def amend_permission(dest_dir: str) -> None:
+def _get_existing_chromedriver_version(dest_dir: str) -> Optional[str]:
     """
-    Given the parent directory (`dest_dir`) of the `chromedriver` executable,
-    this function changes the permissions to allow it to be executable.
-
-    It's the equivalent of entering this command into the terminal:
-    `chmod +x ./chromedriver`
+    If a `chromedriver` executable already exists in `dest_dir`, this
+    function returns its version string; otherwise it returns `None`.
+
+    The version is read from the sidecar file written by `download` where
+    possible, falling back to asking the binary itself (the output of
+    `./chromedriver --version` looks like
+    "ChromeDriver 125.0.6422.113 (hash...)").
+
+    Either source can hand back something that isn't actually a version
+    (a corrupt sidecar, or some unrelated binary squatting on the
+    'chromedriver' name), so anything `_parse_version` can't digest is
+    treated the same as there being no binary at all
     """
-    # The path of the chromedriver executable
     path = os.path.join(dest_dir, "chromedriver")
-
-    # Change the permission of the file to be executable
-    os.chmod(path, stat.S_IRWXU)
+    if not os.path.exists(path):
+        return None
+
+    # The sidecar avoids even having to spawn the binary
+    sidecar_path = os.path.join(dest_dir, VERSION_SIDECAR_NAME)
+    try:
+        with open(sidecar_path) as file:
+            sidecar_version = file.read().strip()
+        if sidecar_version:
+            _parse_version(sidecar_version)
+            return sidecar_version
+    except (OSError, ValueError):
+        pass
+
+    try:
+        # The timeout guards against a wedged binary hanging the whole run
+        result = subprocess.run(
+            [path, "--version"], capture_output=True, text=True, timeout=10
+        )
+        version = result.stdout.split()[1]
+        _parse_version(version)
+        return version
+    except (OSError, IndexError, ValueError, subprocess.TimeoutExpired):
+        # The binary is broken in some way - treat it as not being there
+        return None
 
 
 def download(dest_dir: str) -> str:
@@ -203,15 +340,30 @@ def download(dest_dir: str) -> str:
 
     - Finds the current Chrome version - `get_chrome_version`
     - Gets the corresponding chromedriver download URL - `get_chromedriver_download_url`
-    - Downloads the data at the URL - `download_chromedriver`
-    - Amends the permissions so `chromedriver` can be used out-the-box - `amend_permission`
+    - Downloads the data at the URL (with the permissions already amended
+      so `chromedriver` can be used out-the-box) - `download_chromedriver`
 
     And returns the path of the downloaded `chromedriver` executable
     """
     version = get_chrome_version()
+
+    # If a previous run already put a chromedriver here whose
+    # major.minor.build matches our Chrome's, it'll still drive this Chrome
+    # fine - skip the whole url-resolution/download pipeline and reuse it
+    existing_version = _get_existing_chromedriver_version(dest_dir)
+    if existing_version is not None:
+        if _parse_version(existing_version)[:3] == _parse_version(version)[:3]:
+            return os.path.abspath(os.path.join(dest_dir, "chromedriver"))
+
     url = get_chromedriver_download_url(version)
     filepath = download_chromedriver(url, dest_dir)
-    amend_permission(dest_dir)
+
+    # The url contains the exact version that was downloaded (e.g.
+    # ".../chrome-for-testing-public/125.0.6422.3/mac-x64/..."), so record
+    # it in the sidecar for the check above on future runs
+    downloaded_version = url.split("/")[-3]
+    with open(os.path.join(dest_dir, VERSION_SIDECAR_NAME), "w") as file:
+        file.write(downloaded_version)
 
     return filepath
 